@@ -1,17 +1,38 @@
 from __future__ import annotations as _annotations
 
 import asyncio
-import random
+import functools
+import imaplib
+import math
+import re
+import sys
+import threading
+import time
 import uuid
 import typing
 import os
+from collections import Counter, defaultdict, deque
 from datetime import datetime, timedelta
-from typing import List, Literal
-
-from pydantic import BaseModel, Field
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Literal
+
+import aiosmtplib
+from pydantic import BaseModel, Field, PrivateAttr
+from selectolax.lexbor import LexborHTMLParser
+from openai import AsyncOpenAI, OpenAIError
 from openai.types.responses import ResponseFunctionToolCall
+from imap_tools.errors import (
+    MailboxFetchError,
+    MailboxFlagError,
+    MailboxLoginError,
+    MailboxTaggedResponseError,
+    MailboxUidsError,
+)
 from imap_tools.mailbox import MailBox
-from imap_tools.query import AND
+from imap_tools.utils import check_command_status
 
 from agents import (
     Agent,
@@ -27,7 +48,6 @@ from agents import (
     handoff,
     trace,
 )
-from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX
 
 # --- Agent Context ---
 # This class holds the state of our email agent's operations.
@@ -38,18 +58,49 @@ class OutreachContact(BaseModel):
     status: Literal["initial_sent", "follow_up_1_sent", "follow_up_2_sent", "replied", "unresponsive"] = "initial_sent"
     last_contact_date: datetime
 
+# Display names for OutreachContact.status in reports.
+_STATUS_LABELS = {
+    "initial_sent": "Initial Sent",
+    "follow_up_1_sent": "Follow Up 1 Sent",
+    "follow_up_2_sent": "Follow Up 2 Sent",
+    "replied": "Replied",
+    "unresponsive": "Unresponsive",
+}
+
 class MedicalNewsSummary(BaseModel):
     source_email_subject: str
     summary: str
     trend: str
     date: datetime
 
+# How far back the bi-weekly medical trend report looks.
+MEDICAL_TREND_WINDOW = timedelta(days=14)
+
 class EmailAgentContext(BaseModel):
     outreach_list: List[OutreachContact] = Field(default_factory=list)
     medical_summaries: List[MedicalNewsSummary] = Field(default_factory=list)
     weekly_report: List[str] = Field(default_factory=list)
     # Stores aggregated bi-weekly medical trend reports as plain text.
     bi_weekly_report: List[str] = Field(default_factory=list)
+    # Index of outreach_list by email for O(1) lookups. Not serialized; rebuilt on load.
+    outreach_by_email: Dict[str, OutreachContact] = Field(default_factory=dict, exclude=True)
+    # Running aggregates for the reports, kept up to date at the mutation sites.
+    status_counter: Counter[str] = Field(default_factory=Counter, exclude=True)
+    # Summaries from the last MEDICAL_TREND_WINDOW, oldest first.
+    summaries_by_date: Deque[MedicalNewsSummary] = Field(default_factory=deque, exclude=True)
+    # Guards the lists above when several agent runs share this context concurrently.
+    _lock: asyncio.Lock = PrivateAttr(default_factory=asyncio.Lock)
+
+    def model_post_init(self, __context: Any) -> None:
+        self.outreach_by_email = {contact.email: contact for contact in self.outreach_list}
+        self.status_counter = Counter(contact.status for contact in self.outreach_list)
+        self.summaries_by_date = deque(sorted(self.medical_summaries, key=lambda s: s.date))
+        self.prune_summaries(datetime.now() - MEDICAL_TREND_WINDOW)
+
+    def prune_summaries(self, cutoff: datetime) -> None:
+        """Drops summaries older than `cutoff` from the recent-summaries window."""
+        while self.summaries_by_date and self.summaries_by_date[0].date < cutoff:
+            self.summaries_by_date.popleft()
 
 # --- Email Credentials ---
 # IMPORTANT: Set these environment variables before running the agent.
@@ -59,13 +110,321 @@ class EmailAgentContext(BaseModel):
 # export YAHOO_PASSWORD="your_yahoo_app_password"
 
 YAHOO_IMAP_SERVER = "imap.mail.yahoo.com"
+YAHOO_SMTP_SERVER = "smtp.mail.yahoo.com"
+YAHOO_SMTP_PORT = 465
+
+# --- IMAP Connection Pool ---
+# Logged-in mailboxes are kept open, keyed by (server, email), so repeated fetches in
+# the same process don't pay for a new TLS handshake + LOGIN. Yahoo also rate-limits
+# clients that reconnect too often. This only helps a long-running process
+# (EMAIL_AGENT_WATCH=1). A one-shot cron run connects once and logs out at exit.
+
+# Send a NOOP before reusing a connection that has been idle this long (seconds).
+MAILBOX_NOOP_INTERVAL = 20 * 60
+
+# How long a single IMAP IDLE may block before being re-issued (seconds). RFC 2177
+# asks clients to re-issue IDLE at least every 29 minutes.
+YAHOO_IDLE_TIMEOUT = 29 * 60
+
+# While in IDLE, wake up this often (seconds) to check whether we've been asked to stop.
+YAHOO_IDLE_POLL_INTERVAL = 5
+
+# Errors that mean the cached connection is dead and should be replaced.
+_MAILBOX_CONNECTION_ERRORS = (MailboxLoginError, imaplib.IMAP4.error, OSError)
+
+_mailbox_pool: dict[tuple[str, str], MailBox] = {}
+_mailbox_last_used: dict[tuple[str, str], float] = {}
+_mailbox_pool_lock = asyncio.Lock()
+
+
+def _evict_mailbox(key: tuple[str, str]) -> None:
+    """Removes a mailbox from the pool and closes it, ignoring errors on a dead socket."""
+    mailbox = _mailbox_pool.pop(key, None)
+    _mailbox_last_used.pop(key, None)
+    if mailbox is not None:
+        try:
+            mailbox.logout()
+        except Exception:
+            pass
+
+
+async def _run_blocking(func, *args):
+    """
+    Runs a blocking IMAP call in a worker thread. If the caller is cancelled, waits for
+    the thread to finish first so a connection is never used by two threads at once.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+def _connect_mailbox(server: str, email_address: str, password: str) -> MailBox:
+    mailbox = MailBox(server)
+    mailbox.login(email_address, password, 'INBOX')
+    return mailbox
+
+
+async def _get_mailbox(server: str, email_address: str, password: str) -> MailBox:
+    """
+    Returns a logged-in mailbox for the given account, reusing a pooled connection
+    when one is available and still alive.
+    """
+    key = (server, email_address)
+    async with _mailbox_pool_lock:
+        mailbox = _mailbox_pool.get(key)
+        if mailbox is not None:
+            # Long-idle connections are often dropped server-side; check with a NOOP.
+            if time.monotonic() - _mailbox_last_used.get(key, 0.0) >= MAILBOX_NOOP_INTERVAL:
+                try:
+                    await _run_blocking(mailbox.client.noop)
+                except _MAILBOX_CONNECTION_ERRORS:
+                    _evict_mailbox(key)
+                    mailbox = None
+
+        if mailbox is None:
+            mailbox = await _run_blocking(_connect_mailbox, server, email_address, password)
+            _mailbox_pool[key] = mailbox
+
+        _mailbox_last_used[key] = time.monotonic()
+        return mailbox
+
+
+def close_mailbox_pool() -> None:
+    """Logs out of every pooled mailbox. Call once on shutdown."""
+    for key in list(_mailbox_pool):
+        _evict_mailbox(key)
+
+
+# --- SMTP Sender ---
+# Outgoing mail is queued to background workers that each keep one authenticated SMTP
+# session open, so TLS + AUTH is paid once per run rather than once per email.
+# Sending is opt-in: set EMAIL_AGENT_SEND_EMAIL=1, otherwise `send_email` only prints.
+
+# How long `send_email` waits for a queued message to be sent (seconds).
+SMTP_SEND_TIMEOUT = 120
+
+_smtp_queue: asyncio.Queue[tuple[EmailMessage, asyncio.Future] | None] | None = None
+_smtp_workers: list[asyncio.Task] = []
+
+
+async def _smtp_connect(email_address: str, password: str) -> aiosmtplib.SMTP:
+    """Opens an SMTP session and logs in. The session is closed if login fails."""
+    smtp = aiosmtplib.SMTP(hostname=YAHOO_SMTP_SERVER, port=YAHOO_SMTP_PORT, use_tls=True)
+    await smtp.connect()
+    try:
+        await smtp.login(email_address, password)
+    except BaseException:
+        smtp.close()
+        raise
+    return smtp
+
+
+async def _smtp_sender(queue: asyncio.Queue, email_address: str, password: str) -> None:
+    """Sends queued messages over one long-lived SMTP session until it receives None."""
+    smtp: aiosmtplib.SMTP | None = None
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            message, future = item
+            if future.done():
+                # send_email already gave up on this message (timed out or cancelled).
+                continue
+            try:
+                # The server may have closed an idle session; reconnect once.
+                for attempt in range(2):
+                    if smtp is None:
+                        smtp = await _smtp_connect(email_address, password)
+                    try:
+                        await smtp.send_message(message)
+                        break
+                    except aiosmtplib.SMTPServerDisconnected:
+                        smtp = None
+                        if attempt:
+                            raise
+                if not future.done():
+                    future.set_result(None)
+            except Exception as e:
+                # The session may be in an unknown state; start a fresh one for the next message.
+                if smtp is not None:
+                    smtp.close()
+                    smtp = None
+                if not future.done():
+                    future.set_exception(e)
+    finally:
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                pass
+
+
+def start_smtp_senders() -> None:
+    """Starts the SMTP workers if sending is enabled. Call once at startup."""
+    global _smtp_queue
+    email_address = os.getenv("YAHOO_EMAIL")
+    password = os.getenv("YAHOO_PASSWORD")
+    if not os.getenv("EMAIL_AGENT_SEND_EMAIL") or not email_address or not password:
+        return
+
+    _smtp_queue = asyncio.Queue()
+    for _ in range(max(1, int(os.getenv("EMAIL_AGENT_SMTP_WORKERS", "1")))):
+        _smtp_workers.append(asyncio.create_task(_smtp_sender(_smtp_queue, email_address, password)))
+
+
+async def stop_smtp_senders() -> None:
+    """Lets the SMTP workers finish queued mail, then closes their sessions."""
+    global _smtp_queue
+    if _smtp_queue is None:
+        return
+    for _ in _smtp_workers:
+        await _smtp_queue.put(None)
+    await asyncio.gather(*_smtp_workers, return_exceptions=True)
+    _smtp_workers.clear()
+    _smtp_queue = None
+
+# --- Tool Result Cache ---
+# Tools whose work is expensive and pure (e.g. summarization) return the same string for
+# the same input, so we keep their results for a while instead of recomputing them.
+# Tools with side effects (sending email, updating the context) must not be cached.
+
+_tool_cache: dict[str, tuple[float, str]] = {}
+# "hit" / "miss" counts, for observability.
+tool_cache_stats: Counter[str] = Counter()
+
+
+def cached_tool(ttl: float):
+    """
+    Caches an async tool's result for `ttl` seconds, keyed by its exact arguments.
+    Apply it below `@function_tool` so the tool schema is built from the original signature.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = repr((func.__name__, args, tuple(sorted(kwargs.items()))))
+            now = time.monotonic()
+            # Drop expired entries so a long-running process doesn't grow the cache forever.
+            for expired in [k for k, (expiry, _) in _tool_cache.items() if expiry <= now]:
+                del _tool_cache[expired]
+
+            cached = _tool_cache.get(key)
+            if cached is not None:
+                tool_cache_stats["hit"] += 1
+                return cached[1]
+
+            tool_cache_stats["miss"] += 1
+            result = await func(*args, **kwargs)
+            _tool_cache[key] = (now + ttl, result)
+            return result
+
+        return wrapper
+
+    return decorator
 
 # --- Tools ---
 # These are the functions our agents can use.
 
+# Only the parts the triage agent needs. BODY.PEEK leaves the \Seen flag alone so we
+# can mark the whole batch seen with a single STORE once it has been parsed.
+_YAHOO_FETCH_ITEMS = (
+    "(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] "
+    "BODY.PEEK[TEXT])"
+)
+
+_FETCH_SEQ_RE = re.compile(rb"^\d+ \(")
+
+
+def _uid_set(uids: list[int]) -> str:
+    """Collapses UIDs into an IMAP message set, e.g. [1, 5, 9, 10, 11, 12] -> '1,5,9:12'."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+# Triage and summarization only need the start of an email; longer bodies are cut to
+# keep the LLM prompt (and its token bill) small.
+EMAIL_BODY_MAX_CHARS = 4000
+
+
+def _extract_body(msg: EmailMessage) -> str:
+    """Returns the email's text, preferring the plain-text part and truncated to EMAIL_BODY_MAX_CHARS."""
+    body_part = msg.get_body(preferencelist=("plain", "html"))
+    if body_part is None:
+        return ""
+    try:
+        content = body_part.get_content()
+    except (LookupError, UnicodeError):
+        # Unknown or wrong charset: decode leniently rather than drop the email.
+        content = (body_part.get_payload(decode=True) or b"").decode("utf-8", errors="replace")
+
+    if body_part.get_content_subtype() == "html":
+        tree = LexborHTMLParser(content)
+        tree.strip_tags(["script", "style"])
+        content = tree.text(separator=" ", strip=True)
+    return content[:EMAIL_BODY_MAX_CHARS]
+
+
+def _parse_fetch_response(data: list) -> list[dict]:
+    """Turns the raw response of a bulk `UID FETCH _YAHOO_FETCH_ITEMS` into email dictionaries."""
+    # Each message arrives as one or more (prefix, literal) tuples followed by b')'.
+    messages: list[dict[str, bytes]] = []
+    for part in data:
+        if not isinstance(part, tuple):
+            continue
+        prefix, literal = part
+        if _FETCH_SEQ_RE.match(prefix):
+            messages.append({"header": b"", "text": b""})
+        if not messages:
+            continue
+        if b"HEADER.FIELDS" in prefix:
+            messages[-1]["header"] = literal
+        elif b"BODY[TEXT]" in prefix:
+            messages[-1]["text"] = literal
+
+    parser = BytesParser(policy=policy.default)
+    emails = []
+    for raw in messages:
+        msg = parser.parsebytes(raw["header"] + raw["text"])
+        emails.append({
+            "from": str(msg.get("From", "")),
+            "subject": str(msg.get("Subject", "")),
+            "body": _extract_body(msg),
+        })
+    return emails
+
+
+def _fetch_unseen(mailbox: MailBox) -> list[dict]:
+    """Fetches all unseen emails in one UID FETCH and marks them as seen. Blocking."""
+    client = mailbox.client
+
+    result = client.uid("SEARCH", None, "UNSEEN")
+    check_command_status(result, MailboxUidsError)
+    uids = [int(uid) for uid in result[1][0].split()]
+    if not uids:
+        return []
+    message_set = _uid_set(uids)
+
+    result = client.uid("FETCH", message_set, _YAHOO_FETCH_ITEMS)
+    check_command_status(result, MailboxFetchError)
+    emails = _parse_fetch_response(result[1])
+
+    result = client.uid("STORE", message_set, "+FLAGS", "(\\Seen)")
+    check_command_status(result, MailboxFlagError)
+    return emails
+
+
 async def read_yahoo_emails() -> list[dict] | str:
     """
-    Connects to the Yahoo IMAP server and reads unseen emails.
+    Reads unseen emails from the Yahoo IMAP server over a pooled connection.
+    All unseen messages are fetched in a single UID FETCH and then marked as seen.
     Returns a list of email dictionaries or an error message string.
     """
     email_address = os.getenv("YAHOO_EMAIL")
@@ -74,19 +433,72 @@ async def read_yahoo_emails() -> list[dict] | str:
     if not email_address or not password:
         return "Error: YAHOO_EMAIL and YAHOO_PASSWORD environment variables are not set."
 
-    emails = []
-    try:
-        with MailBox(YAHOO_IMAP_SERVER).login(email_address, password, 'INBOX') as mailbox:
-            # Fetch unseen emails. The `mark_seen=True` default will mark them as seen.
-            for msg in mailbox.fetch(AND(seen=False)):
-                emails.append({
-                    "from": msg.from_,
-                    "subject": msg.subject,
-                    "body": msg.text or msg.html
-                })
-        return emails
-    except Exception as e:
-        return f"Error connecting to Yahoo IMAP or fetching emails: {e}"
+    key = (YAHOO_IMAP_SERVER, email_address)
+    # A pooled connection may have been dropped since the last cycle, so retry once
+    # on a fresh connection before giving up.
+    for attempt in range(2):
+        try:
+            mailbox = await _get_mailbox(YAHOO_IMAP_SERVER, email_address, password)
+            return await _run_blocking(_fetch_unseen, mailbox)
+        except _MAILBOX_CONNECTION_ERRORS as e:
+            _evict_mailbox(key)
+            if attempt:
+                return f"Error connecting to Yahoo IMAP or fetching emails: {e}"
+        except Exception as e:
+            return f"Error connecting to Yahoo IMAP or fetching emails: {e}"
+
+
+def _idle_wait(mailbox: MailBox, stop: threading.Event) -> list[bytes]:
+    """
+    Waits in IMAP IDLE until the server sends something, YAHOO_IDLE_TIMEOUT passes or
+    `stop` is set, then leaves IDLE. Blocking.
+    """
+    deadline = time.monotonic() + YAHOO_IDLE_TIMEOUT
+    mailbox.idle.start()
+    responses: list[bytes] = []
+    while not stop.is_set() and time.monotonic() < deadline:
+        started = time.monotonic()
+        responses = mailbox.idle.poll(timeout=YAHOO_IDLE_POLL_INTERVAL)
+        if responses:
+            break
+        # poll() swallows EOF and returns [] at once, so an early empty result means the
+        # server hung up. Raise instead of spinning until the deadline.
+        if time.monotonic() - started < YAHOO_IDLE_POLL_INTERVAL / 2:
+            raise OSError("IMAP connection closed during IDLE")
+    mailbox.idle.stop()
+    return responses
+
+
+async def yahoo_idle_loop(queue: asyncio.Queue[dict], stop: threading.Event) -> None:
+    """
+    Long-running task that pushes new Yahoo emails onto `queue`.
+    Waits in IMAP IDLE and only fetches when the server announces new mail.
+    Set `stop` before cancelling the task so an in-progress IDLE ends promptly.
+    """
+    email_address = os.getenv("YAHOO_EMAIL")
+    password = os.getenv("YAHOO_PASSWORD")
+    key = (YAHOO_IMAP_SERVER, email_address)
+
+    while True:
+        new_emails = await read_yahoo_emails()
+        if isinstance(new_emails, str):
+            print(f"Could not fetch emails: {new_emails}")
+            await asyncio.sleep(60)
+            continue
+        for email in new_emails:
+            await queue.put(email)
+
+        # Block until the server reports EXISTS/RECENT. A timeout just re-issues IDLE;
+        # a dropped connection breaks out to fetch again in case we missed something.
+        while True:
+            try:
+                mailbox = await _get_mailbox(YAHOO_IMAP_SERVER, email_address, password)
+                responses = await _run_blocking(_idle_wait, mailbox, stop)
+            except (*_MAILBOX_CONNECTION_ERRORS, MailboxTaggedResponseError):
+                _evict_mailbox(key)
+                break
+            if any(b"EXISTS" in r or b"RECENT" in r for r in responses):
+                break
 
 @function_tool
 async def read_gmail_and_download_attachments(subject_keyword: str) -> str:
@@ -99,7 +511,29 @@ async def read_gmail_and_download_attachments(subject_keyword: str) -> str:
 async def send_email(to: str, subject: str, body: str) -> str:
     """Sends an email."""
     print(f"TOOL: Sending email to {to} with subject '{subject}'")
-    print(f"BODY:\n{body}")
+    if _smtp_queue is None:
+        print(f"BODY:\n{body}")
+        return "Email sent successfully."
+
+    message = EmailMessage()
+    message["From"] = os.getenv("YAHOO_EMAIL")
+    message["To"] = to
+    message["Subject"] = subject
+    message.set_content(body)
+
+    future = asyncio.get_running_loop().create_future()
+    await _smtp_queue.put((message, future))
+    try:
+        await asyncio.wait_for(future, SMTP_SEND_TIMEOUT)
+    except TimeoutError:
+        # Still queued messages are dropped, but one already being sent may go out, so
+        # this is not a failure the agent should retry.
+        return (
+            f"Email queued but not confirmed after {SMTP_SEND_TIMEOUT} seconds; it may still "
+            "have been sent. Do not resend it."
+        )
+    except (aiosmtplib.SMTPException, OSError) as e:
+        return f"Error sending email: {e}"
     return "Email sent successfully."
 
 @function_tool
@@ -109,6 +543,7 @@ async def draft_response(email_body: str) -> str:
     return f"This is a drafted response to:\n---\n{email_body[:50]}...\n---"
 
 @function_tool
+@cached_tool(ttl=3600)
 async def summarize_and_identify_trends(text: str) -> str:
     """Summarizes a text and identifies key trends."""
     print("TOOL: Summarizing text and identifying trends...")
@@ -129,15 +564,43 @@ async def add_medical_summary_to_context(
         summary: The summary of the article.
         trend: The key trend identified.
     """
-    new_summary = MedicalNewsSummary(
+    # Every field is produced locally (the SDK already validated the tool arguments),
+    # so skip Pydantic validation.
+    new_summary = MedicalNewsSummary.model_construct(
         source_email_subject=source_email_subject,
         summary=summary,
         trend=trend,
         date=datetime.now(),
     )
-    context.context.medical_summaries.append(new_summary)
+    async with context.context._lock:
+        context.context.medical_summaries.append(new_summary)
+        context.context.summaries_by_date.append(new_summary)
+        context.context.prune_summaries(new_summary.date - MEDICAL_TREND_WINDOW)
     return "Successfully added medical summary to context."
 
+# Email templates for the supplier outreach tools, filled in with `str.format_map`.
+_OUTREACH_TEMPLATE = (
+    "Subject: Exploring Distribution Opportunities in Kuwait with {supplier_name}\n\n"
+    "Dear {supplier_name} Team,\n\n"
+    "My name is [Your Name] and I am the [Your Title] at [Your Company]. We are a leading distributor of medical supplies in Kuwait, and we have been following your company's impressive work and innovative products with great interest.\n\n"
+    "We believe that your products would be an excellent addition to our portfolio, and we are confident that we can establish a strong market presence for you in Kuwait. We would be very interested in discussing the possibility of a distribution partnership.\n\n"
+    "Would you be available for a brief call next week to explore this further?\n\n"
+    "Best regards,\n"
+    "[Your Name]\n"
+    "[Your Title]\n"
+    "[Your Company]\n"
+    "[Your Contact Information]"
+)
+
+_FOLLOWUP_TEMPLATE = (
+    "Subject: Checking In: Distribution Opportunities in Kuwait\n\n"
+    "Dear {supplier_name} Team,\n\n"
+    "I hope this email finds you well. I'm writing to follow up on my previous message regarding a potential distribution partnership in Kuwait.\n\n"
+    "We are very enthusiastic about the possibility of working together and would be happy to answer any questions you might have.\n\n"
+    "Best regards,\n"
+    "[Your Name]"
+)
+
 @function_tool
 async def draft_supplier_outreach_email(supplier_name: str) -> str:
     """
@@ -147,33 +610,13 @@ async def draft_supplier_outreach_email(supplier_name: str) -> str:
         supplier_name: The name of the supplier company.
     """
     print(f"TOOL: Drafting outreach email for {supplier_name}...")
-    template = (
-        f"Subject: Exploring Distribution Opportunities in Kuwait with {supplier_name}\n\n"
-        f"Dear {supplier_name} Team,\n\n"
-        "My name is [Your Name] and I am the [Your Title] at [Your Company]. We are a leading distributor of medical supplies in Kuwait, and we have been following your company's impressive work and innovative products with great interest.\n\n"
-        "We believe that your products would be an excellent addition to our portfolio, and we are confident that we can establish a strong market presence for you in Kuwait. We would be very interested in discussing the possibility of a distribution partnership.\n\n"
-        "Would you be available for a brief call next week to explore this further?\n\n"
-        "Best regards,\n"
-        "[Your Name]\n"
-        "[Your Title]\n"
-        "[Your Company]\n"
-        "[Your Contact Information]"
-    )
-    return template
+    return _OUTREACH_TEMPLATE.format_map({"supplier_name": supplier_name})
 
 @function_tool
 async def draft_follow_up_email(supplier_name: str) -> str:
     """Drafts a brief, friendly follow-up email."""
     print(f"TOOL: Drafting follow-up email for {supplier_name}...")
-    template = (
-        f"Subject: Checking In: Distribution Opportunities in Kuwait\n\n"
-        f"Dear {supplier_name} Team,\n\n"
-        "I hope this email finds you well. I'm writing to follow up on my previous message regarding a potential distribution partnership in Kuwait.\n\n"
-        "We are very enthusiastic about the possibility of working together and would be happy to answer any questions you might have.\n\n"
-        "Best regards,\n"
-        "[Your Name]"
-    )
-    return template
+    return _FOLLOWUP_TEMPLATE.format_map({"supplier_name": supplier_name})
 
 @function_tool
 async def update_outreach_contact_in_context(
@@ -183,21 +626,29 @@ async def update_outreach_contact_in_context(
     status: Literal["initial_sent", "follow_up_1_sent", "follow_up_2_sent", "replied", "unresponsive"],
 ) -> str:
     """Adds or updates a supplier contact in the outreach list in the shared context."""
-    # Check if contact already exists
-    for contact in context.context.outreach_list:
-        if contact.email == email:
+    async with context.context._lock:
+        # Check if contact already exists
+        contact = context.context.outreach_by_email.get(email)
+        if contact is not None:
+            counter = context.context.status_counter
+            counter[contact.status] -= 1
+            if counter[contact.status] <= 0:
+                del counter[contact.status]
+            counter[status] += 1
             contact.status = status
             contact.last_contact_date = datetime.now()
             return f"Successfully updated contact {name} with status {status}."
 
-    # If not, add new contact
-    new_contact = OutreachContact(
-        name=name,
-        email=email,
-        status=status,
-        last_contact_date=datetime.now(),
-    )
-    context.context.outreach_list.append(new_contact)
+        # If not, add new contact. Arguments were validated against the tool signature.
+        new_contact = OutreachContact.model_construct(
+            name=name,
+            email=email,
+            status=status,
+            last_contact_date=datetime.now(),
+        )
+        context.context.outreach_list.append(new_contact)
+        context.context.outreach_by_email[email] = new_contact
+        context.context.status_counter[status] += 1
     return f"Successfully added new contact {name} to outreach list."
 
 # ---------------------------------------------------------------------------
@@ -209,7 +660,8 @@ async def generate_weekly_supplier_report(
     context: RunContextWrapper[EmailAgentContext],
 ) -> str:
     """Creates a weekly supplier outreach report and saves it to the context."""
-    today = datetime.now().date()
+    now = datetime.now()
+    today = now.date()
 
     if not context.context.outreach_list:
         report = f"Weekly Supplier Outreach Report ({today}):\n\nNo supplier outreach activity this week."
@@ -219,22 +671,20 @@ async def generate_weekly_supplier_report(
 
         lines = [header, divider]
 
-        status_counts: dict[str, int] = {}
         for contact in context.context.outreach_list:
-            status_counts[contact.status] = status_counts.get(contact.status, 0) + 1
-            days_since_contact = (datetime.now() - contact.last_contact_date).days
+            days_since_contact = (now - contact.last_contact_date).days
             lines.append(
-                f"• {contact.name} ({contact.email}) – {contact.status.replace('_', ' ').title()} – {days_since_contact} days since last contact"
+                f"• {contact.name} ({contact.email}) – {_STATUS_LABELS[contact.status]} – {days_since_contact} days since last contact"
             )
 
         # Add a summary section
         lines.append("\nSummary:")
-        for status, count in status_counts.items():
-            lines.append(f"  - {status.replace('_', ' ').title()}: {count}")
+        for status, count in context.context.status_counter.items():
+            lines.append(f"  - {_STATUS_LABELS[status]}: {count}")
 
         # Identify unresponsive suppliers (no reply after second follow-up)
-        unresponsive = [c for c in context.context.outreach_list if c.status == "unresponsive"]
-        if unresponsive:
+        if context.context.status_counter["unresponsive"]:
+            unresponsive = [c for c in context.context.outreach_list if c.status == "unresponsive"]
             lines.append("\nUnresponsive Suppliers:")
             for contact in unresponsive:
                 lines.append(f"  • {contact.name} ({contact.email})")
@@ -250,10 +700,10 @@ async def generate_biweekly_medical_trend_report(
     context: RunContextWrapper[EmailAgentContext],
 ) -> str:
     """Creates a bi-weekly medical trend report and saves it to the context."""
-    today = datetime.now().date()
-    cutoff = datetime.now() - timedelta(days=14)
-
-    recent_summaries = [s for s in context.context.medical_summaries if s.date >= cutoff]
+    now = datetime.now()
+    today = now.date()
+    context.context.prune_summaries(now - MEDICAL_TREND_WINDOW)
+    recent_summaries = context.context.summaries_by_date
 
     if not recent_summaries:
         report = (
@@ -265,9 +715,9 @@ async def generate_biweekly_medical_trend_report(
         lines = [header, divider]
 
         # Group summaries by trend
-        trend_groups: dict[str, list[MedicalNewsSummary]] = {}
+        trend_groups: defaultdict[str, list[MedicalNewsSummary]] = defaultdict(list)
         for summary in recent_summaries:
-            trend_groups.setdefault(summary.trend, []).append(summary)
+            trend_groups[summary.trend].append(summary)
 
         for trend, items in trend_groups.items():
             lines.append(f"\nTrend: {trend} – {len(items)} article(s)")
@@ -345,6 +795,12 @@ supplier_outreach_agent = Agent(
     model="gpt-3.5-turbo",
 )
 
+# Agents the triage agent can hand off to, by name.
+_triage_targets = {
+    agent.name: agent
+    for agent in (koc_tender_agent, medical_news_agent, response_drafting_agent, supplier_outreach_agent)
+}
+
 # 5. Triage Agent (The first agent to see an email)
 triage_agent = Agent(
     name="Triage Agent",
@@ -355,43 +811,110 @@ triage_agent = Agent(
         "- 'Response Drafting Agent': Use for general inquiries or supplier emails that need a direct response.\n\n"
         "Based on the email content, select the single best agent to hand off to."
     ),
-    handoffs=[koc_tender_agent, medical_news_agent, response_drafting_agent, supplier_outreach_agent],
+    # Wrap the targets in Handoff objects once here. Bare agents are converted (including
+    # their JSON schema) by the SDK again on every turn of every run.
+    handoffs=[handoff(agent) for agent in _triage_targets.values()],
     model="gpt-3.5-turbo",
 )
 
-# --- Main Application Logic ---
-
-async def process_yahoo_emails(context: EmailAgentContext):
-    """
-    - Monitors Yahoo emails.
-    - Drafts responses for approval.
-    - Identifies medical news, summarizes it, and updates the context.
-    """
-    print("\n--- Task: Processing Yahoo Emails ---")
-    
-    new_emails = await read_yahoo_emails()
-
-    if isinstance(new_emails, str):
-        print(f"Could not fetch emails: {new_emails}")
-        return
-
-    if not new_emails:
-        print("No new emails to process.")
+# --- Triage Cache ---
+# Newsletters and repeat senders produce near-identical subjects. We remember which agent
+# the triage agent picked, keyed by an embedding of sender + subject, and route similar
+# emails straight to that agent without another triage call.
+# The cache lives in memory, so it is only used in watch mode (EMAIL_AGENT_WATCH=1). A
+# one-shot run would start empty every time and just pay for the extra embedding calls.
+
+TRIAGE_EMBEDDING_MODEL = "text-embedding-3-small"
+# Minimum cosine similarity for a cached routing decision to be reused.
+TRIAGE_CACHE_THRESHOLD = 0.93
+TRIAGE_CACHE_MAX_ENTRIES = 256
+# How long a routing decision stays valid, per target agent (seconds). Newsletters are
+# stable; emails that need a reply are judged case by case, so they expire quickly.
+_TRIAGE_CACHE_TTL = {
+    "Medical News Agent": 7 * 24 * 3600,
+    "KOC Tender Agent": 24 * 3600,
+    "Response Drafting Agent": 10 * 60,
+    "Supplier Outreach Agent": 10 * 60,
+}
+
+# (unit-length embedding, target agent name, expiry), least recently used first.
+_triage_cache: list[tuple[list[float], str, float]] = []
+_openai_client: AsyncOpenAI | None = None
+
+
+async def _embed_for_triage(email: dict) -> list[float] | None:
+    """Returns a unit-length embedding of the email's sender and subject, or None on failure."""
+    global _openai_client
+    try:
+        if _openai_client is None:
+            _openai_client = AsyncOpenAI()
+        response = await _openai_client.embeddings.create(
+            model=TRIAGE_EMBEDDING_MODEL, input=f"{email['subject']}\n{email['from']}"
+        )
+    except OpenAIError as e:
+        print(f"Triage cache unavailable: {e}")
+        return None
+    vector = response.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _lookup_triage_cache(embedding: list[float]) -> Agent[EmailAgentContext] | None:
+    """Returns the agent a similar email was routed to, if any."""
+    now = time.monotonic()
+    _triage_cache[:] = [entry for entry in _triage_cache if entry[2] > now]
+
+    best_index, best_score = -1, TRIAGE_CACHE_THRESHOLD
+    for index, (cached, _, _) in enumerate(_triage_cache):
+        score = sum(a * b for a, b in zip(embedding, cached))
+        if score >= best_score:
+            best_index, best_score = index, score
+    if best_index < 0:
+        return None
+
+    entry = _triage_cache.pop(best_index)
+    _triage_cache.append(entry)
+    return _triage_targets.get(entry[1])
+
+
+def _remember_triage(embedding: list[float], agent_name: str) -> None:
+    """Caches a triage routing decision, evicting the least recently used entry when full."""
+    ttl = _TRIAGE_CACHE_TTL.get(agent_name)
+    if ttl is None:
         return
+    _triage_cache.append((embedding, agent_name, time.monotonic() + ttl))
+    if len(_triage_cache) > TRIAGE_CACHE_MAX_ENTRIES:
+        _triage_cache.pop(0)
 
-    print(f"Fetched {len(new_emails)} new email(s).")
+# --- Main Application Logic ---
 
-    for email in new_emails:
+async def _process_one(email: dict, context: EmailAgentContext, sem: asyncio.Semaphore):
+    """Runs a single email through the triage agent and prints what happened."""
+    async with sem:
         print(f"\nProcessing email from {email['from']} with subject: '{email['subject']}'")
         email_content = f"From: {email['from']}\nSubject: {email['subject']}\n\n{email['body']}"
-        
+
+        # Skip triage when a similar email was routed recently.
+        embedding = await _embed_for_triage(email) if os.getenv("EMAIL_AGENT_WATCH") else None
+        starting_agent = _lookup_triage_cache(embedding) if embedding is not None else None
+        if starting_agent is not None:
+            print(f"Triage cache hit: routing directly to {starting_agent.name}")
+        else:
+            starting_agent = triage_agent
+
         conversation_id = uuid.uuid4().hex[:16]
         with trace("Email Processing", group_id=conversation_id):
             input_items = [{"role": "user", "content": email_content}]
             result = await Runner.run(
-                triage_agent, typing.cast(list[TResponseInputItem], input_items), context=context
+                starting_agent, typing.cast(list[TResponseInputItem], input_items), context=context
             )
 
+            if starting_agent is triage_agent and embedding is not None:
+                for new_item in result.new_items:
+                    if isinstance(new_item, HandoffOutputItem):
+                        _remember_triage(embedding, new_item.target_agent.name)
+                        break
+
             for new_item in result.new_items:
                 agent_name = new_item.agent.name
                 if isinstance(new_item, MessageOutputItem):
@@ -409,10 +932,75 @@ async def process_yahoo_emails(context: EmailAgentContext):
                     print(f"{agent_name}: Tool output: {new_item.output}")
                 else:
                     print(f"{agent_name}: Skipping item: {new_item.__class__.__name__}")
-    
+
+
+async def process_yahoo_emails(context: EmailAgentContext, new_emails: list[dict] | None = None):
+    """
+    - Monitors Yahoo emails.
+    - Drafts responses for approval.
+    - Identifies medical news, summarizes it, and updates the context.
+
+    If `new_emails` is given (from `watch_yahoo_emails`), processes those instead of
+    polling the server.
+    """
+    print("\n--- Task: Processing Yahoo Emails ---")
+
+    if new_emails is None:
+        new_emails = await read_yahoo_emails()
+
+    if isinstance(new_emails, str):
+        print(f"Could not fetch emails: {new_emails}")
+        return
+
+    if not new_emails:
+        print("No new emails to process.")
+        return
+
+    print(f"Fetched {len(new_emails)} new email(s).")
+
+    # Each email is an independent conversation, so run them concurrently (bounded to
+    # stay within OpenAI rate limits).
+    sem = asyncio.Semaphore(max(1, int(os.getenv("EMAIL_AGENT_CONCURRENCY", "8"))))
+    results = await asyncio.gather(
+        *(_process_one(email, context, sem) for email in new_emails), return_exceptions=True
+    )
+    for email, result in zip(new_emails, results):
+        if isinstance(result, Exception):
+            print(f"Failed to process email '{email['subject']}': {result!r}")
+
     print("--- Task: Yahoo Emails Complete ---")
 
 
+async def watch_yahoo_emails(context: EmailAgentContext):
+    """
+    - Keeps an IMAP IDLE session open and processes Yahoo emails as they arrive.
+    - Runs until cancelled.
+    """
+    queue: asyncio.Queue[dict] = asyncio.Queue()
+    stop = threading.Event()
+    idle_task = asyncio.create_task(yahoo_idle_loop(queue, stop))
+    getter = None
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait([getter, idle_task], return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                # Nothing will fill the queue any more; surface why instead of waiting forever.
+                idle_task.result()
+                raise RuntimeError("Yahoo IDLE loop stopped unexpectedly.")
+            new_emails = [getter.result()]
+            while not queue.empty():
+                new_emails.append(queue.get_nowait())
+            await process_yahoo_emails(context, new_emails)
+    finally:
+        if getter is not None:
+            getter.cancel()
+        # Leave IDLE and wait for the IMAP thread before the pool is closed.
+        stop.set()
+        idle_task.cancel()
+        await asyncio.wait([idle_task])
+
+
 async def process_koc_tenders(context: EmailAgentContext):
     """
     - Accesses Gmail to download attachments from KOC tenders.
@@ -439,14 +1027,16 @@ async def manage_supplier_outreach(context: EmailAgentContext):
     ]
 
     # 2. Contact new suppliers that are not already in our list
+    prompts: list[str] = []
+    seen_emails = set(context.outreach_by_email)
     for supplier in new_suppliers:
-        is_new = not any(c.email == supplier["email"] for c in context.outreach_list)
+        is_new = supplier["email"] not in seen_emails
         if is_new:
+            seen_emails.add(supplier["email"])
             print(f"New supplier found: {supplier['name']}. Initiating outreach.")
-            prompt = (
+            prompts.append(
                 f"Contact the new supplier named '{supplier['name']}' at the email address '{supplier['email']}'."
             )
-            await Runner.run(supplier_outreach_agent, [{"role": "user", "content": prompt}], context=context)
 
     # 3. Check for and send follow-ups
     today = datetime.now()
@@ -456,15 +1046,28 @@ async def manage_supplier_outreach(context: EmailAgentContext):
         # Follow up after 2 days
         if contact.status == "initial_sent" and days_since_contact >= 2:
             print(f"Contact {contact.name} needs a 2-day follow-up. Sending...")
-            prompt = (
-                f"Send a 2-day follow-up email to '{contact.name}' at '{contact.email}'. "
-                "Keep it brief and friendly, just checking in on our previous message."
-            )
             # We can reuse the same outreach agent, the prompt will guide it.
             # For a more complex system, we might have a dedicated follow-up agent.
-            await Runner.run(supplier_outreach_agent, [{"role": "user", "content": prompt}], context=context)
             # The agent itself should update the context to 'follow_up_1_sent'
             # We need to add instructions for this. For now, we'll assume it does.
+            prompts.append(
+                f"Send a 2-day follow-up email to '{contact.name}' at '{contact.email}'. "
+                "Keep it brief and friendly, just checking in on our previous message."
+            )
+
+    # 4. Run all outreach actions concurrently; each one is an independent conversation.
+    sem = asyncio.Semaphore(5)
+
+    async def run_outreach(prompt: str):
+        async with sem:
+            try:
+                await Runner.run(supplier_outreach_agent, [{"role": "user", "content": prompt}], context=context)
+            except Exception as e:
+                print(f"Supplier outreach failed for prompt {prompt!r}: {e!r}")
+
+    async with asyncio.TaskGroup() as tg:
+        for prompt in prompts:
+            tg.create_task(run_outreach(prompt))
 
     print("--- Task: Supplier Outreach Complete ---")
 
@@ -488,18 +1091,38 @@ async def generate_reports(context: EmailAgentContext):
     print("--- Task: Reports Complete ---")
 
 
+def dump_context(context: EmailAgentContext, path: str | Path) -> None:
+    """Writes the context to `path` as JSON using Pydantic's native (Rust) serializer."""
+    Path(path).write_text(context.model_dump_json(), encoding="utf-8")
+
+
 async def main():
     print("Initializing Email Agent...")
     agent_context = EmailAgentContext()
+    start_smtp_senders()
 
-    # In a real application, this main function would be run on a schedule (e.g., every 5-15 minutes by a cron job)
-    await process_yahoo_emails(agent_context)
-    await process_koc_tenders(agent_context)
-    await manage_supplier_outreach(agent_context)
-    await generate_reports(agent_context)
+    try:
+        # In a real application, this main function would be run on a schedule (e.g., every 5-15 minutes by a cron job)
+        await process_yahoo_emails(agent_context)
+        await process_koc_tenders(agent_context)
+        await manage_supplier_outreach(agent_context)
+        await generate_reports(agent_context)
+
+        # Set EMAIL_AGENT_WATCH=1 to keep running and react to new Yahoo mail via IMAP IDLE
+        # instead of exiting after one cycle.
+        if os.getenv("EMAIL_AGENT_WATCH"):
+            await watch_yahoo_emails(agent_context)
+    finally:
+        await stop_smtp_senders()
+        close_mailbox_pool()
 
     print("\n--- Full Simulation Cycle Complete ---")
-    print("Final Context:", agent_context.model_dump_json(indent=2))
+    # Set EMAIL_AGENT_CONTEXT_PATH to keep a copy of the final context on disk.
+    context_path = os.getenv("EMAIL_AGENT_CONTEXT_PATH")
+    if context_path:
+        dump_context(agent_context, context_path)
+    # Compact JSON: indenting a large context costs far more than it is worth in a log.
+    sys.stdout.write(f"Final Context: {agent_context.model_dump_json()}\n")
 
 
 if __name__ == "__main__":
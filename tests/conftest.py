@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from agents.tool_context import ToolContext
+
+from email_agent.main import EmailAgentContext
+
+
+@pytest.fixture(scope="module")
+def agent_context():
+    """A context shared by the tests in a module. Tests using it must touch disjoint fields."""
+    return EmailAgentContext()
+
+
+@pytest.fixture(scope="session")
+def invoke_tool():
+    """Calls a @function_tool the way the agents SDK does, with JSON-encoded arguments."""
+
+    async def invoke(tool, context, **kwargs):
+        arguments = json.dumps(kwargs)
+        tool_context = ToolContext(
+            context=context, tool_name=tool.name, tool_call_id="test", tool_arguments=arguments
+        )
+        return await tool.on_invoke_tool(tool_context, arguments)
+
+    return invoke
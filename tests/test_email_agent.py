@@ -1,52 +1,500 @@
 import asyncio
+import imaplib
+import math
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import aiosmtplib
 import pytest
+from imap_tools import MailBoxUnencrypted
 
+from email_agent import main
 from email_agent.main import (
+    EMAIL_BODY_MAX_CHARS,
     EmailAgentContext,
+    MedicalNewsSummary,
+    OutreachContact,
+    cached_tool,
+    _parse_fetch_response,
+    _uid_set,
     update_outreach_contact_in_context,
     generate_weekly_supplier_report,
     add_medical_summary_to_context,
     generate_biweekly_medical_trend_report,
+    send_email,
 )
 
-from agents.run_context import RunContextWrapper
-
 
-@pytest.mark.asyncio
-async def test_supplier_workflow():
-    ctx = EmailAgentContext()
-    wrapper = RunContextWrapper(ctx)
+async def test_supplier_workflow(agent_context, invoke_tool):
+    ctx = agent_context
 
     # Add contact
-    await update_outreach_contact_in_context(
-        wrapper,
+    await invoke_tool(
+        update_outreach_contact_in_context,
+        ctx,
         name="Acme Medical",
         email="sales@acmemed.com",
         status="initial_sent",
     )
 
     # Generate weekly report
-    report_text = await generate_weekly_supplier_report(wrapper)
+    report_text = await invoke_tool(generate_weekly_supplier_report, ctx)
 
     assert "Acme Medical" in report_text
     assert ctx.weekly_report, "Weekly report should be stored in context"
 
 
-@pytest.mark.asyncio
-async def test_medical_trend_reporting():
-    ctx = EmailAgentContext()
-    wrapper = RunContextWrapper(ctx)
+async def test_medical_trend_reporting(agent_context, invoke_tool):
+    ctx = agent_context
 
     # Add a medical summary
-    await add_medical_summary_to_context(
-        wrapper,
+    await invoke_tool(
+        add_medical_summary_to_context,
+        ctx,
         source_email_subject="Breakthrough Therapy X",
         summary="A new therapy shows promise in trials.",
         trend="Gene Therapy",
     )
 
     # Generate biweekly report
-    report_text = await generate_biweekly_medical_trend_report(wrapper)
+    report_text = await invoke_tool(generate_biweekly_medical_trend_report, ctx)
 
     assert "Gene Therapy" in report_text
-    assert ctx.bi_weekly_report, "Bi-weekly report should be stored in context" 
\ No newline at end of file
+    assert ctx.bi_weekly_report, "Bi-weekly report should be stored in context"
+
+
+def test_uid_set_collapses_contiguous_ranges():
+    assert _uid_set([3]) == "3"
+    assert _uid_set([1, 2, 3, 4]) == "1:4"
+    assert _uid_set([12, 1, 5, 9, 10, 11]) == "1,5,9:12"
+    assert _uid_set([2, 4, 6]) == "2,4,6"
+
+
+def test_parse_fetch_response_multiple_messages():
+    header_fields = b"BODY[HEADER.FIELDS (FROM SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING)]"
+
+    plain_header = (
+        b"From: Alice <alice@example.com>\r\n"
+        b"Subject: =?utf-8?q?Weekly_digest?=\r\n"
+        b'Content-Type: multipart/alternative; boundary="BB"\r\n\r\n'
+    )
+    plain_text = (
+        b"--BB\r\nContent-Type: text/html\r\n\r\n<p>html version</p>\r\n"
+        b"--BB\r\nContent-Type: text/plain\r\n\r\nplain version\r\n--BB--\r\n"
+    )
+    html_header = b"From: bob@example.com\r\nSubject: HTML only\r\nContent-Type: text/html; charset=utf-8\r\n\r\n"
+    html_text = b"<html><head><style>p {}</style></head><body><p>Hello</p><script>x()</script><p>World</p></body></html>"
+
+    data = [
+        (b"1 (UID 5 " + header_fields + b" {%d}" % len(plain_header), plain_header),
+        (b" BODY[TEXT] {%d}" % len(plain_text), plain_text),
+        b")",
+        # The server may return the literals in a different order than requested.
+        (b"2 (UID 9 BODY[TEXT] {%d}" % len(html_text), html_text),
+        (b" " + header_fields + b" {%d}" % len(html_header), html_header),
+        b")",
+    ]
+
+    emails = _parse_fetch_response(data)
+
+    assert emails[0] == {
+        "from": "Alice <alice@example.com>",
+        "subject": "Weekly digest",
+        "body": "plain version",
+    }
+    assert emails[1]["from"] == "bob@example.com"
+    assert emails[1]["subject"] == "HTML only"
+    assert emails[1]["body"] == "Hello World"
+
+
+def test_extract_body_truncates_long_text():
+    header = b"From: a@example.com\r\nSubject: Long\r\nContent-Type: text/plain\r\n\r\n"
+    text = b"x" * (EMAIL_BODY_MAX_CHARS + 100)
+    data = [(b"1 (UID 1 BODY[HEADER.FIELDS (FROM SUBJECT)] {1}", header), (b" BODY[TEXT] {1}", text), b")"]
+
+    (email,) = _parse_fetch_response(data)
+
+    assert len(email["body"]) == EMAIL_BODY_MAX_CHARS
+
+
+async def test_cached_tool_uses_exact_arguments_and_expires(monkeypatch):
+    calls = []
+
+    @cached_tool(ttl=10)
+    async def echo(name: str) -> str:
+        calls.append(name)
+        return f"Dear {name} Team"
+
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+
+    assert await echo("ACME Corp") == "Dear ACME Corp Team"
+    assert await echo("acme corp") == "Dear acme corp Team"
+    assert await echo("ACME Corp") == "Dear ACME Corp Team"
+    assert calls == ["ACME Corp", "acme corp"]
+
+    now[0] += 11
+    assert await echo("ACME Corp") == "Dear ACME Corp Team"
+    assert calls == ["ACME Corp", "acme corp", "ACME Corp"]
+    # The expired "acme corp" entry was evicted on lookup.
+    assert not any("acme corp" in key for key in main._tool_cache)
+
+
+@pytest.fixture
+def triage_cache(monkeypatch):
+    """An empty triage cache with a controllable clock."""
+    now = [1000.0]
+    monkeypatch.setattr(main, "_triage_cache", [])
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_triage_cache_hit_above_threshold(triage_cache):
+    main._remember_triage([1.0, 0.0], "Medical News Agent")
+
+    # cos = 0.99 >= 0.93: reuse the routing decision.
+    assert main._lookup_triage_cache([0.99, math.sqrt(1 - 0.99**2)]) is main.medical_news_agent
+    # cos = 0.5: too different.
+    assert main._lookup_triage_cache([0.5, math.sqrt(0.75)]) is None
+
+
+def test_triage_cache_ttl_depends_on_target(triage_cache):
+    main._remember_triage([1.0, 0.0], "Medical News Agent")
+    main._remember_triage([0.0, 1.0], "Response Drafting Agent")
+    main._remember_triage([0.6, 0.8], "Unknown Agent")  # not cacheable
+
+    triage_cache[0] += 11 * 60
+    assert main._lookup_triage_cache([0.0, 1.0]) is None
+    assert main._lookup_triage_cache([1.0, 0.0]) is main.medical_news_agent
+    assert len(main._triage_cache) == 1
+
+
+def test_triage_cache_evicts_least_recently_used(triage_cache, monkeypatch):
+    monkeypatch.setattr(main, "TRIAGE_CACHE_MAX_ENTRIES", 2)
+    main._remember_triage([1.0, 0.0], "Medical News Agent")
+    main._remember_triage([0.0, 1.0], "KOC Tender Agent")
+
+    # Touch the first entry so the second becomes least recently used.
+    assert main._lookup_triage_cache([1.0, 0.0]) is main.medical_news_agent
+    main._remember_triage([-1.0, 0.0], "KOC Tender Agent")
+
+    assert main._lookup_triage_cache([0.0, 1.0]) is None
+    assert main._lookup_triage_cache([1.0, 0.0]) is main.medical_news_agent
+    assert main._lookup_triage_cache([-1.0, 0.0]) is main.koc_tender_agent
+
+
+async def test_status_change_updates_counter_and_report(invoke_tool):
+    ctx = EmailAgentContext()
+    await invoke_tool(
+        update_outreach_contact_in_context, ctx, name="Acme", email="a@acme.com", status="initial_sent"
+    )
+    await invoke_tool(
+        update_outreach_contact_in_context, ctx, name="Beta", email="b@beta.com", status="initial_sent"
+    )
+    await invoke_tool(
+        update_outreach_contact_in_context, ctx, name="Acme", email="a@acme.com", status="replied"
+    )
+
+    assert ctx.status_counter == {"initial_sent": 1, "replied": 1}
+    assert len(ctx.outreach_list) == 2
+
+    report_text = await invoke_tool(generate_weekly_supplier_report, ctx)
+    assert "  - Initial Sent: 1" in report_text
+    assert "  - Replied: 1" in report_text
+
+    await invoke_tool(
+        update_outreach_contact_in_context, ctx, name="Beta", email="b@beta.com", status="replied"
+    )
+    assert ctx.status_counter == {"replied": 2}
+
+
+async def test_reloaded_context_rebuilds_indexes(invoke_tool):
+    now = datetime.now()
+    original = EmailAgentContext(
+        outreach_list=[
+            OutreachContact(name="Acme", email="a@acme.com", status="unresponsive", last_contact_date=now),
+            OutreachContact(name="Beta", email="b@beta.com", last_contact_date=now),
+        ],
+        medical_summaries=[
+            MedicalNewsSummary(
+                source_email_subject="Old news", summary="Stale.", trend="Old Trend", date=now - timedelta(days=20)
+            ),
+            MedicalNewsSummary(
+                source_email_subject="Fresh news", summary="Recent.", trend="New Trend", date=now - timedelta(days=1)
+            ),
+        ],
+    )
+
+    ctx = EmailAgentContext.model_validate_json(original.model_dump_json())
+
+    assert set(ctx.outreach_by_email) == {"a@acme.com", "b@beta.com"}
+    assert ctx.outreach_by_email["a@acme.com"] is ctx.outreach_list[0]
+    assert ctx.status_counter == {"unresponsive": 1, "initial_sent": 1}
+    assert [s.source_email_subject for s in ctx.summaries_by_date] == ["Fresh news"]
+
+    report_text = await invoke_tool(generate_biweekly_medical_trend_report, ctx)
+    assert "New Trend" in report_text
+    assert "Old Trend" not in report_text
+
+    # Updating a reloaded contact goes through the index instead of adding a duplicate.
+    await invoke_tool(
+        update_outreach_contact_in_context, ctx, name="Beta", email="b@beta.com", status="replied"
+    )
+    assert len(ctx.outreach_list) == 2
+    assert ctx.status_counter == {"unresponsive": 1, "replied": 1}
+
+
+class StubMailBox:
+    """Stands in for a logged-in imap_tools MailBox."""
+
+    def __init__(self):
+        self.client = self
+        self.noops = 0
+        self.noop_error = None
+        self.logged_out = False
+
+    def noop(self):
+        self.noops += 1
+        if self.noop_error is not None:
+            raise self.noop_error
+
+    def logout(self):
+        self.logged_out = True
+
+
+@pytest.fixture
+def mailbox_pool(monkeypatch):
+    """An empty IMAP pool whose connections are StubMailBoxes, with a controllable clock."""
+    now = [1000.0]
+    connections = []
+
+    def connect(server, email_address, password):
+        connections.append(StubMailBox())
+        return connections[-1]
+
+    monkeypatch.setattr(main, "_mailbox_pool", {})
+    monkeypatch.setattr(main, "_mailbox_last_used", {})
+    monkeypatch.setattr(main, "_connect_mailbox", connect)
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    monkeypatch.setenv("YAHOO_EMAIL", "me@yahoo.com")
+    monkeypatch.setenv("YAHOO_PASSWORD", "app-password")
+    return now, connections
+
+
+async def test_mailbox_pool_reuses_connection(mailbox_pool):
+    now, connections = mailbox_pool
+
+    first = await main._get_mailbox(main.YAHOO_IMAP_SERVER, "me@yahoo.com", "app-password")
+    now[0] += 60
+    second = await main._get_mailbox(main.YAHOO_IMAP_SERVER, "me@yahoo.com", "app-password")
+
+    assert first is second
+    assert len(connections) == 1
+    assert first.noops == 0
+
+
+async def test_mailbox_pool_checks_idle_connections_with_noop(mailbox_pool):
+    now, connections = mailbox_pool
+    first = await main._get_mailbox(main.YAHOO_IMAP_SERVER, "me@yahoo.com", "app-password")
+
+    # Still alive after a long idle period: reused after a NOOP.
+    now[0] += main.MAILBOX_NOOP_INTERVAL
+    assert await main._get_mailbox(main.YAHOO_IMAP_SERVER, "me@yahoo.com", "app-password") is first
+    assert first.noops == 1
+
+    # Dropped by the server: evicted and replaced.
+    now[0] += main.MAILBOX_NOOP_INTERVAL
+    first.noop_error = imaplib.IMAP4.abort("socket error: EOF")
+    replacement = await main._get_mailbox(main.YAHOO_IMAP_SERVER, "me@yahoo.com", "app-password")
+
+    assert replacement is not first
+    assert first.logged_out
+    assert len(connections) == 2
+
+
+async def test_read_yahoo_emails_retries_once_on_connection_error(mailbox_pool, monkeypatch):
+    _, connections = mailbox_pool
+    outcomes = [OSError("connection reset"), [{"from": "a@example.com", "subject": "Hi", "body": ""}]]
+
+    def fetch_unseen(mailbox):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(main, "_fetch_unseen", fetch_unseen)
+
+    assert await main.read_yahoo_emails() == [{"from": "a@example.com", "subject": "Hi", "body": ""}]
+    assert len(connections) == 2
+    assert connections[0].logged_out
+    assert not connections[1].logged_out
+
+
+async def test_read_yahoo_emails_gives_up_after_second_failure(mailbox_pool, monkeypatch):
+    _, connections = mailbox_pool
+
+    def fetch_unseen(mailbox):
+        raise imaplib.IMAP4.abort("socket error: EOF")
+
+    monkeypatch.setattr(main, "_fetch_unseen", fetch_unseen)
+
+    result = await main.read_yahoo_emails()
+
+    assert result.startswith("Error connecting to Yahoo IMAP or fetching emails:")
+    assert len(connections) == 2
+    assert all(mailbox.logged_out for mailbox in connections)
+    assert main._mailbox_pool == {}
+
+
+def _serve_idle_then_hang_up(sock):
+    """Minimal IMAP server: logs in, selects, answers IDLE with "+ idling" and closes."""
+    conn, _ = sock.accept()
+    with conn, conn.makefile("rb") as f:
+        conn.sendall(b"* OK [CAPABILITY IMAP4rev1 IDLE] ready\r\n")
+        for line in f:
+            tag, command = line.split()[:2]
+            command = command.upper()
+            if command == b"CAPABILITY":
+                conn.sendall(b"* CAPABILITY IMAP4rev1 IDLE\r\n" + tag + b" OK done\r\n")
+            elif command == b"LOGIN":
+                conn.sendall(tag + b" OK LOGIN done\r\n")
+            elif command == b"SELECT":
+                conn.sendall(b"* 0 EXISTS\r\n" + tag + b" OK [READ-WRITE] SELECT done\r\n")
+            elif command == b"IDLE":
+                conn.sendall(b"+ idling\r\n")
+                return
+
+
+def test_idle_wait_raises_when_server_hangs_up(monkeypatch):
+    monkeypatch.setattr(main, "YAHOO_IDLE_POLL_INTERVAL", 1)
+    monkeypatch.setattr(main, "YAHOO_IDLE_TIMEOUT", 10)
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        server = threading.Thread(target=_serve_idle_then_hang_up, args=(sock,), daemon=True)
+        server.start()
+        mailbox = MailBoxUnencrypted("127.0.0.1", sock.getsockname()[1]).login("user", "pass")
+        started = time.monotonic()
+        with pytest.raises(main._MAILBOX_CONNECTION_ERRORS):
+            main._idle_wait(mailbox, threading.Event())
+        assert time.monotonic() - started < 2
+        server.join(timeout=5)
+
+
+async def test_watch_stops_when_idle_loop_dies(monkeypatch):
+    async def failing_idle_loop(queue, stop):
+        await queue.put({"subject": "first"})
+        raise ValueError("boom")
+
+    processed = []
+
+    async def record(context, new_emails=None):
+        processed.extend(new_emails)
+
+    monkeypatch.setattr(main, "yahoo_idle_loop", failing_idle_loop)
+    monkeypatch.setattr(main, "process_yahoo_emails", record)
+    with pytest.raises(ValueError, match="boom"):
+        await asyncio.wait_for(main.watch_yahoo_emails(EmailAgentContext()), 5)
+    assert processed == [{"subject": "first"}]
+
+
+class FakeSMTP:
+    """Stands in for aiosmtplib.SMTP; `send_message` raises the queued errors in order."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+        self.is_connected = True
+
+    async def send_message(self, message):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(message["Subject"])
+
+    def close(self):
+        self.is_connected = False
+
+    async def quit(self):
+        self.is_connected = False
+
+
+@pytest.fixture
+def smtp_sessions(monkeypatch):
+    """Each `_smtp_connect` call takes the next item: a FakeSMTP to return or an error to raise."""
+    sessions = []
+
+    async def fake_connect(email_address, password):
+        session = sessions.pop(0)
+        if isinstance(session, Exception):
+            raise session
+        return session
+
+    monkeypatch.setattr(main, "_smtp_connect", fake_connect)
+    return sessions
+
+
+async def _run_sender(*subjects, cancel_first=False):
+    """Feeds messages to one `_smtp_sender` and returns their futures once it has stopped."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    futures = []
+    for subject in subjects:
+        message = EmailMessage()
+        message["Subject"] = subject
+        futures.append(loop.create_future())
+        await queue.put((message, futures[-1]))
+    if cancel_first:
+        futures[0].cancel()
+    await queue.put(None)
+    await main._smtp_sender(queue, "me@example.com", "secret")
+    return futures
+
+
+async def test_smtp_sender_reconnects_once_after_disconnect(smtp_sessions):
+    stale, fresh = FakeSMTP(aiosmtplib.SMTPServerDisconnected("idle timeout")), FakeSMTP()
+    smtp_sessions.extend([stale, fresh])
+
+    futures = await _run_sender("a", "b")
+
+    assert [f.result() for f in futures] == [None, None]
+    assert fresh.sent == ["a", "b"]
+    assert not smtp_sessions
+
+
+async def test_smtp_sender_recovers_from_failed_login(smtp_sessions):
+    session = FakeSMTP()
+    smtp_sessions.extend([aiosmtplib.SMTPAuthenticationError(535, "bad credentials"), session])
+
+    futures = await _run_sender("a", "b")
+
+    assert isinstance(futures[0].exception(), aiosmtplib.SMTPAuthenticationError)
+    assert futures[1].result() is None
+    assert session.sent == ["b"]
+
+
+async def test_smtp_sender_skips_messages_the_caller_gave_up_on(smtp_sessions):
+    session = FakeSMTP()
+    smtp_sessions.append(session)
+
+    futures = await _run_sender("a", "b", cancel_first=True)
+
+    assert futures[0].cancelled()
+    assert session.sent == ["b"]
+
+
+async def test_send_email_timeout_is_not_reported_as_failure(monkeypatch, invoke_tool, smtp_sessions):
+    queue = asyncio.Queue()
+    monkeypatch.setattr(main, "_smtp_queue", queue)
+    monkeypatch.setattr(main, "SMTP_SEND_TIMEOUT", 0.01)
+
+    result = await invoke_tool(send_email, EmailAgentContext(), to="a@example.com", subject="s", body="b")
+
+    assert "may still have been sent" in result
+    assert not result.startswith("Error")
+    # The worker drops the message instead of sending it after the caller gave up.
+    session = FakeSMTP()
+    smtp_sessions.append(session)
+    await queue.put(None)
+    await main._smtp_sender(queue, "me@example.com", "secret")
+    assert session.sent == []